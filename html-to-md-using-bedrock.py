@@ -1,39 +1,116 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
 import warnings
 import boto3
-import json
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import orjson  # C JSON (de)serialization for the Bedrock request/response bodies
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
 import tiktoken  # OpenAI tokenizer, adjust if using a different tokenizer
 from bs4 import BeautifulSoup  # For metadata extraction and HTML processing
-import re
+from lxml import etree  # Streaming parse for the single-pass metadata/body extraction
+from markdownify import markdownify  # Deterministic HTML to Markdown for plain structural HTML
 
 # Suppress SyntaxWarnings (specifically invalid escape sequence warning)
 warnings.filterwarnings("ignore", category=SyntaxWarning)
 
-# Initialize AWS Bedrock client using default AWS credentials
-bedrock_client = boto3.client(
+BEDROCK_REGION = "us-east-1"  # Adjust region as needed
+MODEL_ID = "amazon.titan-tg1-large"  # Titan text model; request/response bodies use its format
+
+# Connection pool large enough for the concurrent chunk conversions (keep `concurrency` at or
+# below it), with adaptive retries so Bedrock throttling backs off instead of failing the chunk
+MAX_POOL_CONNECTIONS = 64
+boto_config = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    tcp_keepalive=True
+)
+
+# Initialize AWS Bedrock client using default AWS credentials; one session is shared by all clients
+boto_session = boto3.session.Session()
+bedrock_client = boto_session.client(
     "bedrock-runtime",
-    region_name="us-east-1"  # Adjust region as needed
+    region_name=BEDROCK_REGION,
+    config=boto_config
 )
 
-# Initialize tokenizer (ensure compatibility with your LLM)
-tokenizer = tiktoken.get_encoding("cl100k_base")
+# Keep downloaded BPE files in a persistent location instead of the temp dir
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tiktoken"))
+
+
+# Tokenizer lookup (ensure compatibility with your LLM), cached per encoding name
+@lru_cache(maxsize=None)
+def get_tokenizer(name="cl100k_base"):
+    return tiktoken.get_encoding(name)
+
+
+# Pre-warm the default encoding at import so the first request does not pay for it
+get_tokenizer()
 MAX_TOKEN_LIMIT = 4096  # Example token limit for the model
 
+TEXT_GENERATION_CONFIG = {
+    "maxTokenCount": 1000,  # Limit the input to 1000 tokens per chunk
+    "temperature": 0.3,  # More deterministic output
+    "topP": 0.9
+}
+# Largest HTML chunk (in tokens) the chunk size controller may pick: Markdown drops the tags, so it
+# is normally well under half the tokens of its HTML; denser chunks come back with completionReason
+# "LENGTH" and make the controller shrink again. Also leaves room in the context window for the prompt.
+CHUNK_SIZE_OUTPUT_LIMIT = min(MAX_TOKEN_LIMIT - 1000, 2 * TEXT_GENERATION_CONFIG["maxTokenCount"])
+# Request body with the constant generation config serialized once; only the prompt is filled in per call
+_BODY_TEMPLATE = b'{"inputText":%s,"textGenerationConfig":' + orjson.dumps(TEXT_GENERATION_CONFIG) + b'}'
+
+# Start tag probe used by is_html on the first IS_HTML_PROBE_SIZE characters of the input
+_TAG_RE = re.compile(rb'<[a-zA-Z][^>]*>')
+IS_HTML_PROBE_SIZE = 4096
+
+# The model's "END" stop token: a standalone word at the very end of a chunk's output
+# (so words like WEEKEND or BACKEND are left alone)
+_END_TOKEN_RE = re.compile(r'\s*\bEND\s*$')
+
+# Constructs markdownify cannot render faithfully (custom elements, merged table cells);
+# documents containing them are converted with Bedrock instead
+_BEDROCK_ONLY_RE = re.compile(r'<(?:[a-z][a-z0-9]*-[\w.-]*|t[dh]\b[^>]*\b(?:rowspan|colspan)\s*=)', re.I)
+
+# In-memory LRU of converted chunks keyed by the sha256 of the request, so identical
+# chunks (re-runs, repeated boilerplate) skip the Bedrock call. Failures, empty outputs and
+# truncated (completionReason "LENGTH") outputs are not cached.
+MARKDOWN_CACHE_SIZE = 4096
+_markdown_cache = OrderedDict()
+_markdown_cache_lock = threading.Lock()
+
 
 # Function to automatically remove invalid escape sequences
 def fix_escape_sequences(input_string):
+    # Literal patterns only, so str.replace (C-level, no regex engine) does the job
     # Replace all invalid escape sequences like \:
-    fixed_string = re.sub(r'\\:', ':', input_string)  # Fix specifically for '\:'
+    fixed_string = input_string.replace('\\:', ':')  # Fix specifically for '\:'
     # Remove unwanted escape sequences like \n, \t, etc.
-    fixed_string = re.sub(r'\\n', '', fixed_string)  # Remove '\n' escape
-    fixed_string = re.sub(r'\\t', '', fixed_string)  # Remove '\t' escape
-    fixed_string = re.sub(r'\\r', '', fixed_string)  # Remove '\r' escape (if needed)
+    fixed_string = fixed_string.replace('\\n', '')  # Remove '\n' escape
+    fixed_string = fixed_string.replace('\\t', '')  # Remove '\t' escape
+    fixed_string = fixed_string.replace('\\r', '')  # Remove '\r' escape (if needed)
 
     return fixed_string
 
 
-# Extract metadata from HTML content
+# Parse with lxml (C parser) unless the caller already holds a parsed tree.
+# Parse once and pass the soup to extract_metadata/strip_head instead of re-parsing the markup.
+def parse_html(html_content):
+    if isinstance(html_content, BeautifulSoup):
+        return html_content
+    return BeautifulSoup(html_content, "lxml")
+
+
+# Extract metadata from a parsed soup (raw markup is parsed first)
 def extract_metadata(html_content):
-    soup = BeautifulSoup(html_content, "html.parser")
+    soup = parse_html(html_content)
     metadata = {}
     if soup.title and soup.title.string:
         metadata["title"] = soup.title.string.strip()
@@ -43,33 +120,112 @@ def extract_metadata(html_content):
     return metadata
 
 
+# Serialize <body> from a parsed soup (raw markup is parsed first)
 def strip_head(html_content):
-    soup = BeautifulSoup(html_content, "html.parser")
+    soup = parse_html(html_content)
     if soup.body:
         return str(soup.body)
-    return html_content
+    return str(html_content)
+
+
+def extract_metadata_and_body(html_bytes):
+    """
+    Single streaming pass over the document with lxml's iterparse.
+    Returns (metadata, body_html, body_nonempty): the same metadata as extract_metadata, the
+    same <body> markup as strip_head, and whether the body has any non-whitespace text.
+    <head> is cleared once it has been read; elements inside <body> are never cleared, since
+    lxml's clear() would also drop the text that follows them.
+
+    >>> extract_metadata_and_body('<title>Café</title><p>naïve “quotes”</p>'.encode("utf-8"))
+    ({'title': 'Café'}, '<body><p>naïve “quotes”</p></body>', True)
+    >>> extract_metadata_and_body('<body><meta name="a" content="b">Only text here</body>')
+    ({'a': 'b'}, '<body><meta name="a" content="b">Only text here</body>', True)
+    >>> extract_metadata_and_body('<body><div><meta itemprop="name" content="x">After meta<p>p</p></div></body>')[1]
+    '<body><div><meta itemprop="name" content="x">After meta<p>p</p></div></body>'
+    >>> big_script = '<script>var x="' + 'a' * 10_500_000 + '"</script>'
+    >>> result = extract_metadata_and_body('<title>T</title><body>' + big_script + '<p>Visible</p></body>')
+    >>> result[0], result[1].endswith('<p>Visible</p></body>'), result[2]
+    ({'title': 'T'}, True, True)
+    """
+    parse_kwargs = {"encoding": "utf-8"}
+    if isinstance(html_bytes, str):
+        html_bytes = html_bytes.encode("utf-8")
+    else:
+        # libxml2 assumes Latin-1 for bytes without a declared charset; default to UTF-8
+        # and only leave the detection to libxml2 when the bytes are not valid UTF-8
+        try:
+            html_bytes.decode("utf-8")
+        except UnicodeDecodeError:
+            parse_kwargs = {}
+
+    metadata_elements = []
+    body = None
+    try:
+        for _, elem in etree.iterparse(BytesIO(html_bytes), events=("end",), html=True, **parse_kwargs):
+            if elem.tag in ("title", "meta"):
+                metadata_elements.append(elem)
+            elif elem.tag == "head":
+                elem.clear(keep_tail=True)
+            elif elem.tag == "body" and body is None:
+                body = elem
+    except etree.XMLSyntaxError:
+        # lxml refuses empty (or whitespace-only) documents outright
+        return {}, "", False
+
+    if body is None and html_bytes.strip():
+        # iterparse silently stops emitting events after a text node over ~10 MB, even with
+        # huge_tree; parse the whole document in one go instead
+        root = etree.fromstring(html_bytes, etree.HTMLParser(huge_tree=True, **parse_kwargs))
+        if root is not None:
+            metadata_elements = list(root.iter("title", "meta"))
+            body = root.find("body")
+
+    metadata = _metadata_from_elements(metadata_elements)
+    if body is None:
+        return metadata, html_bytes.decode("utf-8", errors="replace"), False
+    body_html = etree.tostring(body, method="html", encoding="unicode", with_tail=False)
+    return metadata, body_html, _has_visible_text(body)
+
+
+# Same rules as extract_metadata: the first <title> (like soup.title.string) and every <meta name>
+def _metadata_from_elements(elements):
+    title = None
+    seen_title = False
+    meta_tags = {}
+    for elem in elements:
+        if elem.tag == "title":
+            if not seen_title and elem.text:
+                title = elem.text.strip()
+            seen_title = True
+        elif elem.get("name"):
+            meta_tags[elem.get("name").strip()] = (elem.get("content") or "").strip()
+    metadata = {"title": title} if title is not None else {}
+    metadata.update(meta_tags)
+    return metadata
+
+
+# Same notion of "text" as BeautifulSoup's get_text(): ignore comments, scripts and styles
+def _has_visible_text(body):
+    for node in body.iter():
+        if isinstance(node.tag, str) and node.tag not in ("script", "style") and node.text and node.text.strip():
+            return True
+        if node is not body and node.tail and node.tail.strip():
+            return True
+    return False
 
 
 def is_html(content):
-    soup = BeautifulSoup(content, "html.parser")
-    return bool(soup.find())
+    # A start tag near the top is enough to tell; no need to build a parse tree
+    probe = content[:IS_HTML_PROBE_SIZE]
+    if isinstance(probe, str):
+        probe = probe.encode("utf-8")
+    return bool(_TAG_RE.search(probe))
 
 
-def convert_chunk_to_markdown(html_chunk, previous_markdown="", metadata_block="", include_metadata=False):
-    """
-    Converts an HTML chunk to Markdown using AWS Bedrock.
-    For the first chunk, includes the YAML front matter (metadata_block) at the top.
-    The prompt instructs the model to:
-      - Use explicit Markdown syntax for headings: h1 as "# ", h2 as "## ", etc.
-      - Convert paragraphs to plain text.
-      - Convert unordered lists to Markdown lists with "- " prefixes.
-      - Output only one YAML block at the very beginning (if include_metadata is True).
-      - Omit any duplicate metadata or YAML blocks from the body.
-      - Not include the special token "END" in the final output.
-    """
-    if previous_markdown:
-        prompt = f"""
-You are a conversion engine that continues converting HTML to Markdown from previous output.
+# Constant prompt text, built once. Only the metadata block and the HTML chunk vary per call,
+# so every chunk's prompt shares the same prefix.
+_PROMPT_HEADER_CONTINUE = """
+You are a conversion engine that continues converting an HTML document to Markdown.
 Rules:
 - Do NOT output any YAML front matter in this chunk.
 - Convert the following HTML to Markdown:
@@ -80,20 +236,14 @@ Rules:
     - For unordered lists (<ul> and <li>), use Markdown lists with "- ".
     - DO NOT include any raw HTML tags.
 - Do NOT output the special token "END".
-Previous Markdown:
-{previous_markdown}
-
 Now convert the following HTML to Markdown:
-{html_chunk}
-
-Markdown Output:
 """
-    else:
-        prompt = f"""
+_PROMPT_HEADER_FIRST = """
 You are a conversion engine that converts HTML to Markdown.
 Rules:
 - Start the output with a YAML front matter block containing the following metadata exactly as provided:
-{metadata_block if include_metadata else ""}
+"""
+_PROMPT_RULES_FIRST = """
 
   * The YAML block must begin with a line with only '---', followed by key: "value" pairs (one per line), then a line with only '---', then an empty line.
 - Convert the following HTML to Markdown:
@@ -105,110 +255,388 @@ Rules:
     - Do NOT include any raw HTML tags.
     - Do NOT output the special token "END".
 Convert the following HTML to Markdown:
-{html_chunk}
+"""
+_PROMPT_FOOTER = """
 
 Markdown Output:
 """
-    body = json.dumps({
-        "inputText": prompt,
-        "textGenerationConfig": {
-            "maxTokenCount": 1000,  # Limit the input to 1000 tokens per chunk
-            "temperature": 0.3,  # More deterministic output
-            "topP": 0.9
-        }
-    })
+
+
+# Build the Bedrock prompt for one chunk (first chunk carries the YAML front matter)
+def _build_prompt(html_chunk, metadata_block="", include_metadata=False, continuation=False):
+    if continuation:
+        return _PROMPT_HEADER_CONTINUE + html_chunk + _PROMPT_FOOTER
+    return (_PROMPT_HEADER_FIRST + (metadata_block if include_metadata else "") + _PROMPT_RULES_FIRST
+            + html_chunk + _PROMPT_FOOTER)
+
+
+class ChunkSizeController:
+    """
+    Tunes max_chunk_size across calls from measured Bedrock throughput.
+    Each successful chunk conversion records (tokens processed, response time) into an EWMA of
+    tokens per millisecond. After every document, update() moves the chunk size one step in the
+    direction that raised throughput last time and reverses when it drops. A throttled request or
+    a truncated output (Titan completionReason "LENGTH") shrinks it instead, and truncated chunks
+    are never counted as throughput. A document that recorded nothing (all cache hits or failed
+    requests) leaves the size alone. The size stays within [min_size, max_size]; max_size defaults
+    to CHUNK_SIZE_OUTPUT_LIMIT so a chunk's Markdown fits the maxTokenCount output budget.
+    Keep one instance around and pass it to every process_html_in_chunks call.
+    """
+
+    def __init__(self, chunk_size=1000, min_size=250, max_size=None, step=250, alpha=0.3):
+        if max_size is None:
+            max_size = CHUNK_SIZE_OUTPUT_LIMIT
+        self.chunk_size = chunk_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.step = step
+        self.alpha = alpha  # EWMA weight of the newest sample (~ the last 1/alpha chunks)
+        self.throughput = None  # EWMA of tokens per millisecond
+        self._previous_throughput = None
+        self._direction = 1
+        self._shrink = False
+        self._samples = 0  # record()/record_truncation() calls since the last update()
+        self._lock = threading.Lock()
+
+    def record(self, tokens, elapsed_ms):
+        with self._lock:
+            self._samples += 1
+            sample = tokens / max(elapsed_ms, 1e-3)
+            if self.throughput is None:
+                self.throughput = sample
+            else:
+                self.throughput = self.alpha * sample + (1 - self.alpha) * self.throughput
+
+    def record_throttle(self):
+        with self._lock:
+            self._shrink = True
+
+    def record_truncation(self):
+        with self._lock:
+            self._samples += 1
+            self._shrink = True
+
+    def update(self):
+        with self._lock:
+            if self._shrink:
+                self._direction = -1
+                self.chunk_size -= self.step
+                self._shrink = False
+                self._previous_throughput = None
+            elif self._samples:
+                if self._previous_throughput is not None and self.throughput < self._previous_throughput:
+                    self._direction = -self._direction
+                self.chunk_size += self._direction * self.step
+                self._previous_throughput = self.throughput
+            self._samples = 0
+            self.chunk_size = max(self.min_size, min(self.max_size, self.chunk_size))
+            return self.chunk_size
+
+
+def convert_chunk_to_markdown(html_chunk, metadata_block="", include_metadata=False, continuation=False,
+                              chunk_size_controller=None):
+    """
+    Converts an HTML chunk to Markdown using AWS Bedrock.
+    For the first chunk, includes the YAML front matter (metadata_block) at the top.
+    Later chunks (continuation=True) use the continuation prompt; their context comes from the
+    token overlap with the previous chunk, not from its Markdown output.
+    The prompt instructs the model to:
+      - Use explicit Markdown syntax for headings: h1 as "# ", h2 as "## ", etc.
+      - Convert paragraphs to plain text.
+      - Convert unordered lists to Markdown lists with "- " prefixes.
+      - Output only one YAML block at the very beginning (if include_metadata is True).
+      - Omit any duplicate metadata or YAML blocks from the body.
+      - Not include the special token "END" in the final output.
+    Timings and throttling are reported to chunk_size_controller, if given.
+    """
+    prompt = _build_prompt(html_chunk, metadata_block, include_metadata, continuation)
+    body = _BODY_TEMPLATE % orjson.dumps(prompt)
+
+    cache_key = hashlib.sha256(MODEL_ID.encode("utf-8") + b"\n" + body).hexdigest()
+    with _markdown_cache_lock:
+        if cache_key in _markdown_cache:
+            _markdown_cache.move_to_end(cache_key)
+            return _markdown_cache[cache_key]
 
     try:
+        started = time.perf_counter()
         response = bedrock_client.invoke_model(
-            modelId="amazon.titan-tg1-large",  # Use your desired model ID
+            modelId=MODEL_ID,
             contentType="application/json",
             accept="application/json",
             body=body
         )
-        response_body = response['body'].read().decode('utf-8')
-        response_json = json.loads(response_body)
-        markdown_output = response_json["results"][0]["outputText"].strip()
+        response_json = orjson.loads(response['body'].read())
+        result = response_json["results"][0]
+        markdown_output = result["outputText"].strip()
+        completion_reason = result.get("completionReason")
+        input_tokens = response_json.get("inputTextTokenCount", 0)
     except Exception as e:
         print(f"Error during model invocation: {e}")
+        if (chunk_size_controller is not None and isinstance(e, ClientError)
+                and e.response.get("Error", {}).get("Code", "").lower() == "throttlingexception"):
+            chunk_size_controller.record_throttle()
         return ""
+
+    if chunk_size_controller is not None:
+        if completion_reason == "LENGTH":
+            # Output hit maxTokenCount: the chunk is too big, not fast
+            chunk_size_controller.record_truncation()
+        else:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            chunk_size_controller.record(input_tokens, elapsed_ms)
+
+    # Empty output stops assembly and LENGTH means the output was cut off; neither is reusable
+    if markdown_output and completion_reason != "LENGTH":
+        with _markdown_cache_lock:
+            _markdown_cache[cache_key] = markdown_output
+            if len(_markdown_cache) > MARKDOWN_CACHE_SIZE:
+                _markdown_cache.popitem(last=False)
     return markdown_output
 
 
-def process_html_in_chunks(html_content, max_chunk_size=1000, overlap_tokens=100, with_metadata=True):
+def needs_bedrock(html_content):
+    """
+    True if the HTML contains constructs the local markdownify conversion can't handle.
+    """
+    return bool(_BEDROCK_ONLY_RE.search(html_content))
+
+
+def convert_html_with_markdownify(html_content):
+    """
+    Converts HTML to Markdown locally, following the same rules as the Bedrock prompt:
+    "# " style headings, plain-text paragraphs and "- " list items.
+    """
+    return markdownify(html_content, heading_style="ATX", bullets="-").strip()
+
+
+def build_metadata_block(metadata, with_metadata=True):
+    """
+    Renders the extracted metadata as a YAML front matter block ("" if there is none).
+    """
+    if not (with_metadata and metadata):
+        return ""
+    metadata_lines = [f'{key}: "{value}"' for key, value in metadata.items()]
+    return "---\n" + "\n".join(metadata_lines) + "\n---\n\n"  # YAML front matter block
+
+
+def split_into_chunks(tokens, max_chunk_size=1000, overlap_tokens=100):
+    """
+    Splits body tokens into HTML chunks using the sliding window strategy. The token overlap
+    carries context between chunks, so every chunk can be converted independently.
+    """
+    tokenizer = get_tokenizer()
+    total_tokens = len(tokens)
+    chunk_texts = []
+    for start in range(0, total_tokens, max_chunk_size):
+        end = min(start + max_chunk_size, total_tokens)
+        # Use an overlap for context (except for the first chunk)
+        chunk_tokens = tokens[max(start - overlap_tokens, 0):end]
+        chunk_texts.append(tokenizer.decode(chunk_tokens))
+    return chunk_texts
+
+
+def assemble_markdown(converted_chunks, metadata, metadata_block, with_metadata=True):
+    """
+    Joins converted chunks in order, stopping at the first empty chunk or the "END" token,
+    and makes sure the result starts with the YAML front matter.
+    """
+    markdown_chunks = []
+    for markdown_chunk in converted_chunks:
+        if markdown_chunk.strip() == "":
+            break  # Stop at the first chunk that generated no content
+        if _END_TOKEN_RE.search(markdown_chunk):
+            # Only the final chunk can carry the "END" token, so strip it here rather than
+            # scanning the joined output again
+            markdown_chunks.append(_END_TOKEN_RE.sub("", markdown_chunk))
+            break
+        markdown_chunks.append(markdown_chunk)
+
+    aggregated_markdown = "\n".join(markdown_chunks).strip()
+
+    # Ensure the aggregated markdown begins with the YAML front matter.
+    if with_metadata and metadata and not aggregated_markdown.startswith('---'):
+        aggregated_markdown = metadata_block + aggregated_markdown
+    return aggregated_markdown
+
+
+def process_html_in_chunks(html_content, max_chunk_size=1000, overlap_tokens=100, with_metadata=True,
+                           concurrency=8, use_bedrock=False, chunk_size_controller=None):
     """
     Processes the full HTML content in chunks using a sliding window strategy.
+    Plain structural HTML is converted locally with markdownify in one go; Bedrock is used
+    when the body needs it (see needs_bedrock) or when use_bedrock is True.
+    Chunks are independent of each other and are converted with up to `concurrency`
+    Bedrock requests in flight.
+    With a chunk_size_controller, its tuned chunk size replaces max_chunk_size.
     """
+    # One streaming pass: metadata from the full HTML, the <body> without <head> (so metadata
+    # is not in the body conversion), and whether the body has any text at all
+    metadata, body_html, body_nonempty = extract_metadata_and_body(html_content)
     # Handle empty content case: Specifically check if <body> tag is empty
-    soup = BeautifulSoup(html_content, "html.parser")
-    body_content = soup.body
-    if not body_content or not body_content.get_text(strip=True):  # If body is empty or contains no meaningful text
+    if not body_nonempty:  # If body is empty or contains no meaningful text
         print("Error: No content to process.")
         return "", {}  # Return empty output if the HTML content is empty
 
-    # Token count check to avoid exceeding the token limit
-    total_tokens = len(tokenizer.encode(html_content))
+    metadata_block = build_metadata_block(metadata, with_metadata)
+
+    # Mechanical tag-to-Markdown mapping needs no LLM (and no chunking)
+    if not use_bedrock and not needs_bedrock(body_html):
+        print("Debug: Converting locally with markdownify.")
+        return metadata_block + convert_html_with_markdownify(body_html), metadata
+
+    # Tokenize the body once; the same tokens drive the limit check and the chunking
+    tokens = get_tokenizer().encode(body_html)
+    total_tokens = len(tokens)
     print(f"Debug: Total tokens = {total_tokens}")  # Debugging token count
 
+    # Check if the content exceeds the token limit and handle chunking
     if total_tokens > MAX_TOKEN_LIMIT:
         print(f"Token limit exceeded ({total_tokens} tokens), splitting content into chunks.")
+        # Split content into chunks using the sliding window strategy. The token overlap
+        # carries context between chunks, so all of them can be built up front.
+        if chunk_size_controller is not None:
+            max_chunk_size = chunk_size_controller.chunk_size
+        chunk_texts = split_into_chunks(tokens, max_chunk_size, overlap_tokens)
+
+        # Chunks don't depend on each other's output and Bedrock calls are network-bound,
+        # so keep several of them in flight
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(
+                    convert_chunk_to_markdown,
+                    chunk_text,
+                    metadata_block=metadata_block,
+                    include_metadata=(chunk_index == 0),
+                    continuation=(chunk_index > 0),
+                    chunk_size_controller=chunk_size_controller
+                )
+                for chunk_index, chunk_text in enumerate(chunk_texts)
+            ]
+            converted_chunks = []
+            for chunk_index, future in enumerate(futures):
+                markdown_chunk = future.result()
+                converted_chunks.append(markdown_chunk)
+                if markdown_chunk.strip() == "" or _END_TOKEN_RE.search(markdown_chunk):
+                    # Assembly stops at this chunk, so don't start the ones after it
+                    for pending in futures[chunk_index + 1:]:
+                        pending.cancel()
+                    break
+
+        if chunk_size_controller is not None:
+            print(f"Debug: Next chunk size = {chunk_size_controller.update()}")
+    else:
+        print("Token limit not exceeded. Processing as a single chunk.")
+        converted_chunks = [convert_chunk_to_markdown(
+            body_html,
+            metadata_block=metadata_block,
+            include_metadata=with_metadata
+        )]
 
-    # Check if the content exceeds the token limit and handle chunking
-    if total_tokens > MAX_TOKEN_LIMIT:
-        # Extract metadata from the full HTML
-        metadata = extract_metadata(html_content)
-        metadata_block = ""
-        if with_metadata and metadata:
-            metadata_lines = [f'{key}: "{value}"' for key, value in metadata.items()]
-            metadata_block = "---\n" + "\n".join(metadata_lines) + "\n---\n\n"  # YAML front matter block
-
-        # Remove <head> so that metadata is not in the body conversion
-        body_html = strip_head(html_content)
-
-        # Split content into chunks using the sliding window strategy
-        markdown_chunks = []
-        tokens = tokenizer.encode(body_html)
-        total_tokens = len(tokens)
-        start = 0
-        previous_markdown = ""
-        chunk_index = 0
-
-        while start < total_tokens:
-            end = min(start + max_chunk_size, total_tokens)
-            # Use an overlap for context (except for the first chunk)
-            if start > 0:
-                chunk_tokens = tokens[start - overlap_tokens:end]
-            else:
-                chunk_tokens = tokens[start:end]
-            chunk_text = tokenizer.decode(chunk_tokens)
-            include_metadata = (chunk_index == 0)
-            markdown_chunk = convert_chunk_to_markdown(
-                html_chunk=chunk_text,
-                previous_markdown=previous_markdown,
+    aggregated_markdown = assemble_markdown(converted_chunks, metadata, metadata_block, with_metadata)
+    return aggregated_markdown, metadata
+
+
+def process_html_batch(paths, s3_bucket, role_arn, s3_prefix="html-to-md-batch", max_chunk_size=1000,
+                       overlap_tokens=100, with_metadata=True, poll_interval=60, timeout=24 * 60 * 60):
+    """
+    Converts many HTML files with a single Bedrock batch inference job instead of one
+    InvokeModel call per chunk. Every chunk of every document is written as one JSONL record
+    to S3, so the whole set shares one job. Meant for bulk, non-interactive workloads: the job
+    must reach Bedrock's minimum record count, and role_arn must allow Bedrock to read and
+    write s3_bucket.
+    Raises TimeoutError if the job has not finished within `timeout` seconds.
+    Returns a dict mapping each path to (markdown, metadata).
+    """
+    tokenizer = get_tokenizer()
+    results = {}
+    documents = []
+    records = []
+    for doc_index, path in enumerate(paths):
+        # Raw bytes: extract_metadata_and_body tries UTF-8 first, then the declared charset
+        with open(path, "rb") as f:
+            metadata, body_html, body_nonempty = extract_metadata_and_body(f.read())
+        if not body_nonempty:
+            print(f"Error: No content to process in {path}.")
+            results[path] = ("", {})
+            continue
+
+        metadata_block = build_metadata_block(metadata, with_metadata)
+        chunk_texts = split_into_chunks(tokenizer.encode(body_html), max_chunk_size, overlap_tokens)
+        record_ids = []
+        for chunk_index, chunk_text in enumerate(chunk_texts):
+            record_id = f"DOC{doc_index:06d}CHUNK{chunk_index:06d}"
+            prompt = _build_prompt(
+                chunk_text,
                 metadata_block=metadata_block,
-                include_metadata=include_metadata
+                include_metadata=(chunk_index == 0),
+                continuation=(chunk_index > 0)
             )
-            if markdown_chunk.strip() == "":
-                break  # Stop processing if no content is generated
-            markdown_chunks.append(markdown_chunk)
-            previous_markdown = markdown_chunk  # update context
-            if "END" in markdown_chunk:
-                break
-            start += max_chunk_size
-            chunk_index += 1
-
-        aggregated_markdown = "\n".join(markdown_chunks)
-        # Post-process: Remove any occurrence of the "END" token if present
-        aggregated_markdown = aggregated_markdown.replace("END", "").strip()
-
-        # Ensure the aggregated markdown begins with the YAML front matter.
-        if with_metadata and metadata and not aggregated_markdown.startswith('---'):
-            aggregated_markdown = metadata_block + aggregated_markdown
-
-        return aggregated_markdown, metadata
-    else:
-        print("Token limit not exceeded. Processing as a single chunk.")
-        markdown_output, metadata = convert_chunk_to_markdown(html_content, with_metadata=True)
-        return markdown_output, metadata
+            records.append({
+                "recordId": record_id,
+                "modelInput": {"inputText": prompt, "textGenerationConfig": TEXT_GENERATION_CONFIG}
+            })
+            record_ids.append(record_id)
+        documents.append((path, metadata, metadata_block, record_ids))
+
+    if not records:
+        return results
+
+    # One job for all chunks of all documents keeps the batch completion time down
+    # Unique per call, so concurrent batches never share a job name or S3 input key
+    job_name = f"html-to-md-{int(time.time())}-{uuid.uuid4().hex[:12]}"
+    input_key = f"{s3_prefix}/{job_name}/input.jsonl"
+    output_prefix = f"{s3_prefix}/{job_name}/output/"
+    s3_client = boto_session.client("s3", region_name=BEDROCK_REGION, config=boto_config)
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key=input_key,
+        Body=b"\n".join(orjson.dumps(record) for record in records)
+    )
+
+    bedrock_control_client = boto_session.client("bedrock", region_name=BEDROCK_REGION, config=boto_config)
+    job_arn = bedrock_control_client.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=MODEL_ID,
+        inputDataConfig={
+            "s3InputDataConfig": {"s3Uri": f"s3://{s3_bucket}/{input_key}", "s3InputFormat": "JSONL"}
+        },
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{s3_bucket}/{output_prefix}"}}
+    )["jobArn"]
+    print(f"Debug: Submitted batch job {job_arn} with {len(records)} records")
+
+    deadline = time.monotonic() + timeout
+    status = ""
+    while status not in ("Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired"):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Batch job {job_arn} still {status or 'pending'} after {timeout} seconds")
+        time.sleep(poll_interval)
+        status = bedrock_control_client.get_model_invocation_job(jobIdentifier=job_arn)["status"]
+    if status not in ("Completed", "PartiallyCompleted"):
+        print(f"Error: Batch job {job_arn} ended with status {status}.")
+
+    # Bedrock writes one <input file>.out per input file below the output prefix
+    outputs = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=output_prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith(".jsonl.out"):
+                continue
+            output_body = s3_client.get_object(Bucket=s3_bucket, Key=obj["Key"])["Body"].read()
+            for line in output_body.splitlines():
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                if "modelOutput" in record:
+                    outputs[record["recordId"]] = record["modelOutput"]["results"][0]["outputText"].strip()
+                else:
+                    print(f"Error during model invocation for {record.get('recordId')}: {record.get('error')}")
+
+    for path, metadata, metadata_block, record_ids in documents:
+        converted_chunks = [outputs.get(record_id, "") for record_id in record_ids]
+        results[path] = (assemble_markdown(converted_chunks, metadata, metadata_block, with_metadata), metadata)
+    return results
 
 
 if __name__ == "__main__":